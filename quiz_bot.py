@@ -1,74 +1,192 @@
-import os, json, pathlib, random, datetime, logging
+import os, sys, json, array, pathlib, random, asyncio, functools, heapq, logging, time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from telegram import Update, Poll
+from telegram.error import NetworkError, RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, PollAnswerHandler, ContextTypes
+    AIORateLimiter, Application, CommandHandler, PollAnswerHandler, ContextTypes
 )
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "").strip()
+# Public base URL (e.g. https://bot.example.com). When set, the bot serves a
+# webhook instead of long-polling getUpdates.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip()
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
 QUESTIONS_PATH = pathlib.Path("questions.json")
 
 GROUP_QUIZ_LEN = 5
 GROUP_Q_OPEN_PERIOD = 12  # seconds
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
 
-def load_questions():
-    if not QUESTIONS_PATH.exists():
-        logging.error("questions.json not found")
-        return None
+@functools.lru_cache(maxsize=4)
+def _load_questions_cached(mtime_ns: int) -> list | None:
     try:
-        data = json.loads(QUESTIONS_PATH.read_text(encoding="utf-8"))
+        if orjson:
+            data = orjson.loads(QUESTIONS_PATH.read_bytes())
+        else:
+            with QUESTIONS_PATH.open("rb") as f:
+                data = json.load(f)
         if not isinstance(data, list) or not data:
-            logging.error("questions.json invalid or empty")
+            logger.error("questions.json invalid or empty")
             return None
+        for i, q in enumerate(data):
+            if (not isinstance(q, dict)
+                    or not isinstance(q.get("q"), str)
+                    or not isinstance(q.get("opts"), list)
+                    or len(q["opts"]) < 2
+                    or not all(isinstance(o, str) for o in q["opts"])
+                    or not isinstance(q.get("answer"), int)
+                    or not 0 <= q["answer"] < len(q["opts"])):
+                logger.error("questions.json entry %d malformed", i)
+                return None
         return data
     except Exception as e:
-        logging.exception("Failed to parse questions.json: %s", e)
+        logger.exception("Failed to parse questions.json: %s", e)
+        return None
+
+def load_questions() -> list | None:
+    if not QUESTIONS_PATH.exists():
+        logger.error("questions.json not found")
         return None
+    # Keyed by mtime: re-parse only when the file actually changed
+    return _load_questions_cached(QUESTIONS_PATH.stat().st_mtime_ns)
 
 QUIZ = load_questions()
 
-# chat_id -> session
-# {
-#   "session_id": str,
-#   "qids": [int],
-#   "idx": int,
-#   "scores": {uid: {"name": str, "score": int}},
-#   "active_poll_id": str | None
-# }
+# Structure-of-arrays views over the question bank so the send path does
+# plain index lookups instead of per-question dict hashing. Q_ANSWER packs
+# the answer indices into a compact int16 array. Strings are interned so
+# repeated option text ("True"/"False" etc.) shares one object, and the
+# views are tuples: the bank is frozen after load, which also keeps the
+# lru_cache'd parse result safe from accidental mutation.
+Q_TEXT = tuple(sys.intern(q["q"]) for q in QUIZ) if QUIZ else ()
+Q_OPTS = tuple(tuple(sys.intern(o) for o in q["opts"]) for q in QUIZ) if QUIZ else ()
+Q_ANSWER = array.array("h", (q["answer"] for q in QUIZ)) if QUIZ else array.array("h")
+
+@dataclass(slots=True)
+class GroupSession:
+    session_id: str
+    qids: list
+    shuffled: list  # [(options, correct_option_id)] aligned with qids
+    prefixes: list  # "Qn/N: " strings aligned with qids
+    idx: int = 0
+    scores: Counter = field(default_factory=Counter)  # uid -> correct answers
+    names: dict = field(default_factory=dict)  # uid -> display name
+    active_poll_id: str | None = None
+
+# chat_id -> GroupSession
 GROUP_SESSIONS = {}
 
 # poll_id -> (chat_id, correct_option_id)
-POLL_META = {}
+# Bounded: entries for abandoned/expired polls would otherwise accumulate
+# for the life of the process. Oldest entries are evicted past the cap.
+POLL_META_MAX = 4096
+POLL_META = OrderedDict()
+
+def remember_poll(poll_id: str, chat_id: int, correct_option_id: int):
+    POLL_META[poll_id] = (chat_id, correct_option_id)
+    while len(POLL_META) > POLL_META_MAX:
+        POLL_META.popitem(last=False)
+
+# Pre-shuffled (order, inverse) permutation pairs keyed by option count.
+# Built lazily on first use, then reused for the life of the process.
+_PERM_POOL_SIZE = 64
+_PERM_POOLS = {}
+
+def _perm_pool(n: int) -> list:
+    pool = _PERM_POOLS.get(n)
+    if pool is None:
+        pool = []
+        for _ in range(_PERM_POOL_SIZE):
+            order = random.sample(range(n), n)
+            inv = [0] * n
+            for pos, i in enumerate(order):
+                inv[i] = pos
+            pool.append((tuple(order), tuple(inv)))
+        _PERM_POOLS[n] = pool
+    return pool
+
+def shuffle_options(qid: int) -> tuple[list[str], int]:
+    """Return (options, correct_option_id) for a question, in random order."""
+    opts = Q_OPTS[qid]
+    answer = Q_ANSWER[qid]
+    if len(opts) == 2:
+        # True/False questions: a coin flip beats the permutation machinery
+        if random.getrandbits(1):
+            return [opts[1], opts[0]], 1 - answer
+        return [opts[0], opts[1]], answer
+    order, inv = random.choice(_perm_pool(len(opts)))
+    return [opts[i] for i in order], inv[answer]
+
+async def send_with_retry(method, **kwargs):
+    """Call a bot send method, backing off on flood waits and network errors.
+
+    The rate limiter smooths normal traffic; this covers the residual
+    RetryAfter/NetworkError cases so a transient failure doesn't kill a
+    session mid-quiz.
+    """
+    for attempt in range(4):
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            logger.warning("Flood limit hit, waiting %.1fs", e.retry_after)
+            await asyncio.sleep(e.retry_after + random.uniform(0, 0.5))
+        except NetworkError:
+            logger.warning("Network error on send, retry %d", attempt + 1)
+            await asyncio.sleep(2 ** attempt)
+    return await method(**kwargs)
 
 def display_name(user) -> str:
-    if getattr(user, "username", None):
-        return f"@{user.username}"
-    full = f"{getattr(user,'first_name','')} {getattr(user,'last_name','')}".strip()
-    return full if full else str(user.id)
+    username = getattr(user, "username", None)
+    if username:
+        return "@" + username
+    first = getattr(user, "first_name", "") or ""
+    last = getattr(user, "last_name", "") or ""
+    full = (first + " " + last).strip()
+    return full or str(user.id)
+
+SCOREBOARD_HEADER = "🏁 Results (Bottom 10 — lowest score at bottom)\n"
+_SCORE_LINE = "{}. {} — {}".format
 
-def format_scoreboard(scores: dict) -> str:
-    rows = [(v["name"], int(v["score"])) for v in scores.values()]
+def format_scoreboard(scores: Counter, names: dict[int, str]) -> str:
+    rows = [(names[uid], score) for uid, score in scores.items()]
 
     if not rows:
         return "🏁 Results\nNo scores recorded."
 
-    # 1) Sort by score ASC (lowest first)
-    rows.sort(key=lambda x: (x[1], x[0].lower()))
-
-    # 2) Take bottom 10
-    bottom_10 = rows[:10]
-
-    # 3) Reverse display so lowest score is LAST
+    # Bottom 10 by score ASC in O(n log 10), then reverse so the lowest
+    # score displays LAST
+    bottom_10 = heapq.nsmallest(10, rows, key=lambda x: (x[1], x[0].lower()))
     bottom_10.reverse()
 
-    out = ["🏁 Results (Bottom 10 — lowest score at bottom)"]
-    for i, (name, score) in enumerate(bottom_10, 1):
-        out.append(f"{i}. {name} — {score}")
+    return SCOREBOARD_HEADER + "\n".join(
+        _SCORE_LINE(i, name, score) for i, (name, score) in enumerate(bottom_10, 1)
+    )
+
 
-    return "\n".join(out)
 
+# (poll_id, user_id) pairs already processed — Telegram can redeliver
+# updates after a network hiccup, and a replayed poll_answer must not
+# score twice. Bounded the same way as POLL_META.
+SEEN_ANSWERS_MAX = 50_000
+SEEN_ANSWERS = OrderedDict()
 
+def _already_answered(poll_id: str, uid: int) -> bool:
+    key = (poll_id, uid)
+    if key in SEEN_ANSWERS:
+        return True
+    SEEN_ANSWERS[key] = None
+    while len(SEEN_ANSWERS) > SEEN_ANSWERS_MAX:
+        SEEN_ANSWERS.popitem(last=False)
+    return False
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -84,12 +202,14 @@ async def leaderboard_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not s:
         await update.message.reply_text("No active quiz session.")
         return
-    await update.message.reply_text(format_scoreboard(s["scores"]))
+    await update.message.reply_text(format_scoreboard(s.scores, s.names))
 
 async def stopquiz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id in GROUP_SESSIONS:
-        GROUP_SESSIONS.pop(chat_id, None)
+    s = GROUP_SESSIONS.pop(chat_id, None)
+    if s:
+        if s.active_poll_id:
+            POLL_META.pop(s.active_poll_id, None)
         await update.message.reply_text("Quiz session stopped.")
     else:
         await update.message.reply_text("No active quiz session.")
@@ -100,7 +220,7 @@ async def next_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not s:
         await update.message.reply_text("No active quiz session.")
         return
-    s["idx"] += 1
+    s.idx += 1
     await update.message.reply_text("Forcing advance to next question…")
     await send_next_question(context, chat_id, reason="manual")
 
@@ -121,15 +241,14 @@ async def quiz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     qcount = min(GROUP_QUIZ_LEN, len(QUIZ))
     qids = random.sample(range(len(QUIZ)), k=qcount)
-    session_id = f"{chat_id}:{int(datetime.datetime.now().timestamp())}"
+    session_id = f"{chat_id}:{time.time_ns()}"
 
-    GROUP_SESSIONS[chat_id] = {
-        "session_id": session_id,
-        "qids": qids,
-        "idx": 0,
-        "scores": {},
-        "active_poll_id": None,
-    }
+    GROUP_SESSIONS[chat_id] = GroupSession(
+        session_id=session_id,
+        qids=qids,
+        shuffled=[shuffle_options(qid) for qid in qids],
+        prefixes=[f"Q{i+1}/{qcount}: " for i in range(qcount)],
+    )
 
     await update.message.reply_text(
         f"Starting group quiz: {qcount} questions.\n"
@@ -142,25 +261,27 @@ async def send_next_question(context: ContextTypes.DEFAULT_TYPE, chat_id: int, r
     if not s:
         return
 
-    if s["idx"] >= len(s["qids"]):
-        await context.bot.send_message(chat_id=chat_id, text=format_scoreboard(s["scores"]))
+    # Moving on finishes the previous poll; drop its metadata now instead
+    # of waiting for LRU eviction.
+    if s.active_poll_id:
+        POLL_META.pop(s.active_poll_id, None)
+
+    if s.idx >= len(s.qids):
+        await send_with_retry(context.bot.send_message,
+                              chat_id=chat_id, text=format_scoreboard(s.scores, s.names))
         GROUP_SESSIONS.pop(chat_id, None)
         return
 
-    idx = s["idx"]
-    qid = s["qids"][idx]
-    q = QUIZ[qid]
-
-    order = list(range(len(q["opts"])))
-    random.shuffle(order)
-    options = [q["opts"][i] for i in order]
-    correct_option_id = order.index(q["answer"])
+    idx = s.idx
+    qid = s.qids[idx]
+    options, correct_option_id = s.shuffled[idx]
 
-    logging.info("SEND Q%d/%d chat=%s reason=%s", idx+1, len(s["qids"]), chat_id, reason)
+    logger.info("SEND Q%d/%d chat=%s reason=%s", idx+1, len(s.qids), chat_id, reason)
 
-    msg = await context.bot.send_poll(
+    msg = await send_with_retry(
+        context.bot.send_poll,
         chat_id=chat_id,
-        question=f"Q{idx+1}/{len(s['qids'])}: {q['q']}",
+        question=s.prefixes[idx] + Q_TEXT[qid],
         options=options,
         type=Poll.QUIZ,
         correct_option_id=correct_option_id,
@@ -168,8 +289,8 @@ async def send_next_question(context: ContextTypes.DEFAULT_TYPE, chat_id: int, r
         open_period=GROUP_Q_OPEN_PERIOD,
     )
 
-    s["active_poll_id"] = msg.poll.id
-    POLL_META[msg.poll.id] = (chat_id, correct_option_id)
+    s.active_poll_id = msg.poll.id
+    remember_poll(msg.poll.id, chat_id, correct_option_id)
 
     # schedule forced advance (THIS is the key)
     try:
@@ -179,9 +300,9 @@ async def send_next_question(context: ContextTypes.DEFAULT_TYPE, chat_id: int, r
             data={"chat_id": chat_id, "poll_id": msg.poll.id, "idx": idx},
             name=f"adv_{chat_id}_{idx}"
         )
-        logging.info("SCHEDULE ADVANCE chat=%s idx=%s poll=%s", chat_id, idx, msg.poll.id)
+        logger.info("SCHEDULE ADVANCE chat=%s idx=%s poll=%s", chat_id, idx, msg.poll.id)
     except Exception:
-        logging.exception("FAILED to schedule advance job (job-queue not installed?)")
+        logger.exception("FAILED to schedule advance job (job-queue not installed?)")
         await context.bot.send_message(chat_id=chat_id, text="⚠️ Internal error: timer not scheduled.")
 
 async def force_advance_job(context: ContextTypes.DEFAULT_TYPE):
@@ -192,22 +313,24 @@ async def force_advance_job(context: ContextTypes.DEFAULT_TYPE):
 
     s = GROUP_SESSIONS.get(chat_id)
     if not s:
-        logging.info("JOB fired but no session chat=%s", chat_id)
+        logger.info("JOB fired but no session chat=%s", chat_id)
         return
 
     # Only advance if we are still on the same poll/question
-    if s.get("active_poll_id") != poll_id or s.get("idx") != idx:
-        logging.info("JOB ignored (session moved) chat=%s idx=%s active=%s job_poll=%s",
-                     chat_id, s.get("idx"), s.get("active_poll_id"), poll_id)
+    if s.active_poll_id != poll_id or s.idx != idx:
+        logger.info("JOB ignored (session moved) chat=%s idx=%s active=%s job_poll=%s",
+                     chat_id, s.idx, s.active_poll_id, poll_id)
         return
 
-    logging.info("JOB ADVANCE chat=%s idx=%s poll=%s", chat_id, idx, poll_id)
-    s["idx"] += 1
+    logger.info("JOB ADVANCE chat=%s idx=%s poll=%s", chat_id, idx, poll_id)
+    s.idx += 1
     await send_next_question(context, chat_id, reason="timer")
 
 async def on_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ans = update.poll_answer
-    uid = str(ans.user.id)
+    uid = ans.user.id
+    if _already_answered(ans.poll_id, uid):
+        return
     chosen = ans.option_ids[0] if ans.option_ids else None
 
     meta = POLL_META.get(ans.poll_id)
@@ -219,24 +342,38 @@ async def on_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not s:
         return
 
-    # ✅ Always register the user once they answered at least one question
-    entry = s["scores"].setdefault(uid, {"name": display_name(ans.user), "score": 0})
-    entry["name"] = display_name(ans.user)  # keep name fresh
+    # ✅ Always register the user once they answered at least one question.
+    # The display name is stable for the minute a session lasts, so only
+    # compute it on the user's first answer.
+    if uid not in s.names:
+        s.names[uid] = display_name(ans.user)
+    s.scores.setdefault(uid, 0)
 
     # ✅ Only add score if correct
     if chosen == correct:
-        entry["score"] += 1
+        s.scores[uid] += 1
 
 
 def main():
     if not BOT_TOKEN:
-        logging.error("BOT_TOKEN not set")
+        logger.error("BOT_TOKEN not set")
         return
     if not QUIZ:
-        logging.error("QUIZ not loaded")
+        logger.error("QUIZ not loaded")
         return
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Process updates concurrently so one slow Telegram call (e.g. a
+        # retried send) doesn't stall every other chat's handlers.
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30, overall_time_period=1,
+            group_max_rate=20, group_time_period=60,
+        ))
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("quiz", quiz_cmd))
@@ -246,8 +383,27 @@ def main():
 
     app.add_handler(PollAnswerHandler(on_poll_answer))
 
-    logging.info("Bot running...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Webhook mode: Telegram pushes updates to us, removing the polling
+        # round-trip. Expects TLS termination by a reverse proxy in front.
+        logger.info("Bot running (webhook on port %d)...", WEBHOOK_PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=["message", "poll_answer"],
+        )
+        return
+
+    logger.info("Bot running (polling)...")
+    # Long-poll for the server-side maximum and only subscribe to the update
+    # types we actually handle, so each getUpdates batch stays small.
+    app.run_polling(
+        timeout=30,
+        poll_interval=0.0,
+        allowed_updates=["message", "poll_answer"],
+    )
 
 if __name__ == "__main__":
     main()